@@ -1,17 +1,21 @@
 import os
-import json
 import logging
 from typing import Dict, Any, List
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import uvicorn
 from pydantic import BaseModel
-import redis
+import redis.asyncio as redis
 
 from mcp_handlers import GmailHandler, EmailProcessor
 
 # Configuración de logging
-logging.basicConfig(level=logging.INFO)
+# LOG_LEVEL se normaliza una vez (WARN -> WARNING); valores desconocidos usan INFO
+LOG_LEVEL = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").strip().upper())
+if not isinstance(LOG_LEVEL, int) or LOG_LEVEL == logging.NOTSET:
+    LOG_LEVEL = logging.INFO
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 
@@ -39,23 +43,30 @@ class GmailWebhook(BaseModel):
 
 
 # Inicialización de la aplicación
-app = FastAPI(title="MCP Email Automation Server")
-
-# CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+app = FastAPI(title="MCP Email Automation Server", default_response_class=ORJSONResponse)
+
+# CORS: solo para los orígenes de navegador configurados. n8n y el webhook
+# de Gmail llaman servidor a servidor y no necesitan el middleware.
+cors_origins = [o.strip() for o in os.getenv("CORS_ALLOW_ORIGINS", "").split(",") if o.strip()]
+if cors_origins:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=cors_origins,
+        allow_methods=["GET", "POST"],
+        allow_headers=["Content-Type"],
+    )
+
+# Cliente Redis (asíncrono, con pool de conexiones compartido)
+redis_pool = redis.ConnectionPool.from_url(
+    os.getenv('REDIS_URL', 'redis://redis:6379'),
+    max_connections=64,
+    decode_responses=True
 )
-
-# Cliente Redis
-redis_client = redis.Redis(host='redis', port=6379, decode_responses=True)
+redis_client = redis.Redis(connection_pool=redis_pool)
 
 # Handlers
 gmail_handler = GmailHandler()
-email_processor = EmailProcessor()
+email_processor = EmailProcessor(redis_client)
 
 
 @app.on_event("startup")
@@ -63,7 +74,7 @@ async def startup_event():
     """Inicializar conexiones al startup"""
     try:
         # Verificar conexión a Redis
-        redis_client.ping()
+        await redis_client.ping()
         logger.info("✅ Conectado a Redis")
 
         # Inicializar Gmail API
@@ -74,6 +85,12 @@ async def startup_event():
         logger.error(f"❌ Error en startup: {e}")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Cerrar conexiones al shutdown"""
+    await redis_pool.disconnect()
+
+
 @app.get("/")
 async def root():
     return {"message": "MCP Email Automation Server", "status": "running"}
@@ -92,7 +109,7 @@ async def send_email(email: EmailRequest):
         )
 
         # Guardar en cache
-        redis_client.set(f"sent_email:{message_id}", json.dumps(email.dict()))
+        await redis_client.set(f"sent_email:{message_id}", email.model_dump_json())
 
         return {
             "status": "success",
@@ -146,7 +163,7 @@ async def get_unread_emails(max_results: int = 20):
 async def gmail_webhook(webhook: GmailWebhook):
     """Webhook para notificaciones de Gmail"""
     try:
-        logger.info(f"📨 Webhook recibido: {webhook.message_id}")
+        logger.debug("📨 Webhook recibido: %s", webhook.message_id)
 
         # Procesar el email entrante
         await email_processor.process_single_email(
@@ -169,7 +186,7 @@ async def health_check():
     """Endpoint de salud"""
     try:
         # Verificar servicios
-        redis_ok = redis_client.ping()
+        redis_ok = await redis_client.ping()
         gmail_ok = await gmail_handler.health_check()
 
         return {
@@ -186,6 +203,10 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info"
+        # Cada worker tiene su propio EmailProcessor: OPENAI_RPS, OPENAI_CONCURRENCY,
+        # el pool de Redis y la cache local son por worker.
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
+        loop="uvloop",
+        http="httptools",
+        log_level=logging.getLevelName(LOG_LEVEL).lower()
     )
\ No newline at end of file
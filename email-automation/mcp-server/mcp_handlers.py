@@ -1,44 +1,106 @@
 import os
+import asyncio
 import base64
+import hashlib
 import json
 import logging
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Dict, Any
 from email.mime.text import MIMEText
+import google_auth_httplib2
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
 import openai
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 logger = logging.getLogger(__name__)
 
+# Peticiones por lote de la API batch de Gmail (Gmail recomienda 50 o menos)
+GMAIL_BATCH_SIZE = 50
+# Reintentos de sub-peticiones limitadas por tasa (429) dentro de un lote
+GMAIL_BATCH_RETRIES = 3
+
+# Tiempo de vida (segundos) de las categorizaciones cacheadas en Redis
+CATEGORY_CACHE_TTL = 86400
+
+# Entradas máximas de la cache local (en proceso) de categorizaciones; 0 la desactiva
+CATEGORY_CACHE_SIZE = int(os.getenv('CATEGORY_CACHE_SIZE', '10000'))
+
+# Categorías válidas y modelos de OpenAI
+CATEGORIES = frozenset({'urgent', 'important', 'newsletter', 'social', 'personal', 'spam'})
+DEFAULT_CATEGORY = 'important'
+CATEGORY_MODEL = os.getenv('OPENAI_CATEGORY_MODEL', 'gpt-4o-mini')
+RESPONSE_MODEL = os.getenv('OPENAI_RESPONSE_MODEL', 'gpt-3.5-turbo')
+
+# Prompt de sistema estático para categorizar (el proveedor puede cachearlo)
+CATEGORY_SYSTEM_PROMPT = (
+    "Categoriza el email en una de: urgent (requiere atención inmediata), "
+    "important (importante pero no urgente), newsletter (boletines y marketing), "
+    "social (redes sociales y notificaciones), personal (email personal), "
+    "spam (correo no deseado). Responde solo con la categoría."
+)
+
+
+def _is_rate_limited(exception: Exception) -> bool:
+    """Indica si una sub-petición de Gmail falló por límite de tasa"""
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    return status == 429 or (status == 403 and 'ratelimitexceeded' in str(exception).lower())
+
 
 class GmailHandler:
     def __init__(self):
         self.credentials = None
         self.service = None
         self.scopes = ['https://www.googleapis.com/auth/gmail.modify']
+        # httplib2 no es thread-safe: un cliente HTTP autorizado por hilo
+        self._local = threading.local()
+
+    def _thread_http(self):
+        """Obtener el cliente HTTP autorizado del hilo actual"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=build_http())
+            self._local.http = http
+        return http
+
+    async def _execute(self, request):
+        """Ejecutar una petición de googleapiclient sin bloquear el event loop"""
+        return await asyncio.to_thread(lambda: request.execute(http=self._thread_http()))
+
+    def _load_credentials(self):
+        """Cargar credenciales desde variable de entorno o archivo"""
+        creds_json = os.getenv('GMAIL_CREDENTIALS_JSON')
+        if creds_json:
+            creds_info = json.loads(creds_json)
+            return Credentials.from_authorized_user_info(creds_info, self.scopes)
+
+        # Intentar cargar desde archivo
+        creds_path = '/app/credentials/gmail_credentials.json'
+        if os.path.exists(creds_path):
+            return Credentials.from_authorized_user_file(creds_path, self.scopes)
+        return None
 
     async def initialize(self):
         """Inicializar la conexión con Gmail API"""
         try:
-            # Cargar credenciales desde variable de entorno o archivo
-            creds_json = os.getenv('GMAIL_CREDENTIALS_JSON')
-            if creds_json:
-                creds_info = json.loads(creds_json)
-                self.credentials = Credentials.from_authorized_user_info(creds_info, self.scopes)
-            else:
-                # Intentar cargar desde archivo
-                creds_path = '/app/credentials/gmail_credentials.json'
-                if os.path.exists(creds_path):
-                    self.credentials = Credentials.from_authorized_user_file(creds_path, self.scopes)
+            # Lectura de archivo, refresco del token y build() fuera del event loop
+            self.credentials = await asyncio.to_thread(self._load_credentials)
 
             # Refrescar token si es necesario
             if self.credentials and self.credentials.expired and self.credentials.refresh_token:
-                self.credentials.refresh(Request())
+                await asyncio.to_thread(self.credentials.refresh, Request())
 
             if self.credentials:
-                self.service = build('gmail', 'v1', credentials=self.credentials)
+                self.service = await asyncio.to_thread(build, 'gmail', 'v1', credentials=self.credentials)
+                self._local = threading.local()
                 logger.info("✅ Gmail service inicializado correctamente")
             else:
                 logger.warning("⚠️ No se encontraron credenciales de Gmail")
@@ -62,10 +124,10 @@ class GmailHandler:
             raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
 
             # Enviar el email
-            message_obj = self.service.users().messages().send(
+            message_obj = await self._execute(self.service.users().messages().send(
                 userId='me',
                 body={'raw': raw_message}
-            ).execute()
+            ))
 
             logger.info(f"📤 Email enviado a {to}, Message ID: {message_obj['id']}")
             return message_obj['id']
@@ -83,25 +145,61 @@ class GmailHandler:
             if not self.service:
                 await self.initialize()
 
-            results = self.service.users().messages().list(
+            results = await self._execute(self.service.users().messages().list(
                 userId='me',
                 labelIds=['INBOX', 'UNREAD'],
                 maxResults=max_results
-            ).execute()
+            ))
 
             messages = results.get('messages', [])
+            details = {}
+            rate_limited = []
+
+            def _collect(request_id, response, exception):
+                if exception is None:
+                    details[request_id] = response
+                elif _is_rate_limited(exception):
+                    rate_limited.append(request_id)
+                else:
+                    logger.error(f"Error obteniendo email {request_id}: {exception}")
+
+            # Obtener metadatos en lotes, reintentando las sub-peticiones limitadas por tasa
+            pending = [msg['id'] for msg in messages]
+            for attempt in range(GMAIL_BATCH_RETRIES + 1):
+                for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+                    batch = self.service.new_batch_http_request(callback=_collect)
+                    for message_id in pending[start:start + GMAIL_BATCH_SIZE]:
+                        batch.add(
+                            self.service.users().messages().get(
+                                userId='me',
+                                id=message_id,
+                                format='metadata',
+                                metadataHeaders=['Subject', 'From']
+                            ),
+                            request_id=message_id
+                        )
+                    await self._execute(batch)
+
+                if not rate_limited:
+                    break
+                if attempt == GMAIL_BATCH_RETRIES:
+                    logger.error(f"❌ {len(rate_limited)} emails omitidos por límite de tasa de Gmail")
+                    break
+
+                pending = list(rate_limited)
+                rate_limited.clear()
+                await asyncio.sleep(2 ** attempt)
+
             emails = []
 
             for msg in messages:
-                message_detail = self.service.users().messages().get(
-                    userId='me',
-                    id=msg['id'],
-                    format='metadata'
-                ).execute()
+                message_detail = details.get(msg['id'])
+                if message_detail is None:
+                    continue
 
-                headers = message_detail.get('payload', {}).get('headers', [])
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'Sin asunto')
-                from_email = next((h['value'] for h in headers if h['name'] == 'From'), 'Desconocido')
+                headers = {h['name']: h['value'] for h in message_detail.get('payload', {}).get('headers', [])}
+                subject = headers.get('Subject', 'Sin asunto')
+                from_email = headers.get('From', 'Desconocido')
 
                 emails.append({
                     'id': msg['id'],
@@ -121,12 +219,12 @@ class GmailHandler:
     async def mark_as_read(self, message_id: str):
         """Marcar email como leído"""
         try:
-            self.service.users().messages().modify(
+            await self._execute(self.service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={'removeLabelIds': ['UNREAD']}
-            ).execute()
-            logger.info(f"✅ Email {message_id} marcado como leído")
+            ))
+            logger.debug("✅ Email %s marcado como leído", message_id)
         except Exception as e:
             logger.error(f"Error marcando como leído: {e}")
 
@@ -134,7 +232,7 @@ class GmailHandler:
         """Verificar que Gmail API esté funcionando"""
         try:
             if self.service:
-                self.service.users().getProfile(userId='me').execute()
+                await self._execute(self.service.users().getProfile(userId='me'))
                 return True
             return False
         except:
@@ -142,42 +240,117 @@ class GmailHandler:
 
 
 class EmailProcessor:
-    def __init__(self):
-        self.openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client
+        self._category_cache = OrderedDict()
+        # Sin reintentos del SDK: tenacity en _chat es la única política de reintentos
+        self.openai_client = openai.AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_retries=0,
+            timeout=float(os.getenv('OPENAI_TIMEOUT', '30'))
+        )
         self.gmail_handler = GmailHandler()
+        # Límite de emails procesados en paralelo dentro de un lote
+        self.semaphore = asyncio.Semaphore(int(os.getenv('EMAIL_CONCURRENCY', '8')))
+        # Control de concurrencia y de peticiones por segundo hacia OpenAI
+        self.openai_semaphore = asyncio.Semaphore(int(os.getenv('OPENAI_CONCURRENCY', '4')))
+        self.openai_limiter = AsyncLimiter(float(os.getenv('OPENAI_RPS', '5')), 1)
+
+    @retry(
+        retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError)),
+        wait=wait_exponential_jitter(initial=1, max=30),
+        stop=stop_after_attempt(4),
+        reraise=True
+    )
+    async def _chat(self, prompt: str, max_tokens: int, model: str = RESPONSE_MODEL, system: str = None, **params) -> str:
+        """Llamada a OpenAI con reintentos ante límites de tasa o fallos de conexión"""
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+
+        async with self.openai_semaphore, self.openai_limiter:
+            response = await self.openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                **params
+            )
+        return response.choices[0].message.content.strip()
+
+    def _remember_category(self, key: str, category: str, ttl: int = CATEGORY_CACHE_TTL):
+        """Guardar categoría en la cache local, descartando la menos usada"""
+        if CATEGORY_CACHE_SIZE <= 0 or ttl <= 0:
+            return
+        self._category_cache[key] = (category, time.monotonic() + ttl)
+        self._category_cache.move_to_end(key)
+        if len(self._category_cache) > CATEGORY_CACHE_SIZE:
+            self._category_cache.popitem(last=False)
+
+    async def _get_cached_category(self, key: str):
+        """Obtener categoría cacheada (local o Redis), si existe"""
+        entry = self._category_cache.get(key)
+        if entry is not None:
+            category, expires_at = entry
+            if time.monotonic() < expires_at:
+                self._category_cache.move_to_end(key)
+                return category
+            del self._category_cache[key]
+
+        if not self.redis_client:
+            return None
+        try:
+            # Leer también el TTL restante para que la cache local expire a la vez
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                category, ttl = await pipe.get(key).ttl(key).execute()
+        except Exception as e:
+            logger.warning(f"⚠️ Error leyendo cache de categorías: {e}")
+            return None
+
+        if category:
+            self._remember_category(key, category, ttl)
+        return category
+
+    async def _cache_category(self, key: str, category: str):
+        """Guardar categoría en la cache local y en Redis"""
+        self._remember_category(key, category)
+        if not self.redis_client:
+            return
+        try:
+            await self.redis_client.setex(key, CATEGORY_CACHE_TTL, category)
+        except Exception as e:
+            logger.warning(f"⚠️ Error guardando cache de categorías: {e}")
 
     async def categorize_email(self, subject: str, snippet: str, from_email: str) -> str:
         """Categorizar email usando OpenAI"""
-        try:
-            prompt = f"""
-            Analiza el siguiente email y categorízalo en una de estas categorías:
-            - urgent: Requiere atención inmediata
-            - important: Importante pero no urgente
-            - newsletter: Boletines y marketing
-            - social: Redes sociales y notificaciones
-            - personal: Email personal
-            - spam: Correo no deseado
-
-            Email:
-            De: {from_email}
-            Asunto: {subject}
-            Contenido: {snippet[:500]}
+        cache_key = "cat:" + hashlib.blake2b(
+            f"{from_email}|{subject}|{snippet[:500]}".encode(),
+            digest_size=16
+        ).hexdigest()
 
-            Responde solo con la categoría (urgent, important, newsletter, social, personal, spam)
-            """
+        cached = await self._get_cached_category(cache_key)
+        if cached:
+            return cached
 
-            response = self.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=10
-            )
-
-            category = response.choices[0].message.content.strip().lower()
+        try:
+            prompt = f"De: {from_email}\nAsunto: {subject}\n{snippet[:500]}"
+
+            category = (await self._chat(
+                prompt,
+                max_tokens=5,
+                model=CATEGORY_MODEL,
+                system=CATEGORY_SYSTEM_PROMPT,
+                temperature=0
+            )).lower().strip('.')
+            if category not in CATEGORIES:
+                logger.warning(f"⚠️ Categoría desconocida de OpenAI: {category!r}")
+                return DEFAULT_CATEGORY
+
+            await self._cache_category(cache_key, category)
             return category
 
         except Exception as e:
             logger.error(f"Error categorizando email: {e}")
-            return "important"
+            return DEFAULT_CATEGORY
 
     async def generate_auto_response(self, subject: str, content: str, from_email: str) -> str:
         """Generar respuesta automática usando OpenAI"""
@@ -194,13 +367,7 @@ class EmailProcessor:
             Responde con el contenido del email de respuesta (solo el cuerpo).
             """
 
-            response = self.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500
-            )
-
-            return response.choices[0].message.content.strip()
+            return await self._chat(prompt, max_tokens=500)
 
         except Exception as e:
             logger.error(f"Error generando respuesta: {e}")
@@ -209,11 +376,11 @@ class EmailProcessor:
     async def process_single_email(self, message_id: str, thread_id: str, from_email: str, subject: str, snippet: str):
         """Procesar un email individual"""
         try:
-            logger.info(f"🔄 Procesando email: {subject}")
+            logger.debug("🔄 Procesando email: %s", subject)
 
             # Categorizar el email
             category = await self.categorize_email(subject, snippet, from_email)
-            logger.info(f"📂 Email categorizado como: {category}")
+            logger.debug("📂 Email categorizado como: %s", category)
 
             # Acciones basadas en la categoría
             if category == "urgent":
@@ -241,14 +408,21 @@ class EmailProcessor:
             emails = await self.gmail_handler.get_unread_emails(max_emails)
             logger.info(f"🔄 Procesando lote de {len(emails)} emails")
 
-            for email in emails:
-                await self.process_single_email(
-                    email['id'],
-                    email['threadId'],
-                    email['from'],
-                    email['subject'],
-                    email['snippet']
-                )
+            async def _guarded(email: Dict[str, Any]):
+                async with self.semaphore:
+                    return await self.process_single_email(
+                        email['id'],
+                        email['threadId'],
+                        email['from'],
+                        email['subject'],
+                        email['snippet']
+                    )
+
+            results = await asyncio.gather(*[_guarded(email) for email in emails], return_exceptions=True)
+
+            for email, result in zip(emails, results):
+                if isinstance(result, Exception):
+                    logger.error(f"❌ Error procesando email {email['id']}: {result}")
 
             logger.info(f"✅ Lote de emails procesado exitosamente")
 
@@ -34,6 +34,8 @@ N8N_BASIC_AUTH_PASSWORD=password123
 
 # MCP Server
 MCP_SERVER_URL=http://localhost:8000
+# Orígenes de navegador permitidos por CORS (separados por comas)
+CORS_ALLOW_ORIGINS=
 EOF
     echo "⚠️  Por favor configura las credenciales en el archivo .env"
 fi